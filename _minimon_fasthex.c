@@ -0,0 +1,130 @@
+/* Optional compiled accelerator for minimon's hex mode.
+ *
+ * Build it in place with
+ *
+ *   cc -O3 -mssse3 -shared -fPIC $(python3-config --includes) \
+ *      _minimon_fasthex.c -o _minimon_fasthex$(python3-config --extension-suffix)
+ *
+ * minimon.py picks the module up automatically and falls back to its
+ * pure Python formatter when it is missing.  hexline() produces byte
+ * for byte the same lines as the fallback.  With SSSE3 enabled (any
+ * x86-64 CPU since about 2006) a full 16 byte chunk is converted with
+ * a handful of pshufb shuffles: one XMM register holds the whole
+ * chunk, two shuffles against a "0123456789ABCDEF" table turn the
+ * nibbles into hex digits and a compare/mask pair replaces the non
+ * printable characters of the character gutter with dots.  On other
+ * targets a plain C loop is used, which is still well ahead of the
+ * interpreted formatter.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <string.h>
+
+#if defined(__SSSE3__)
+#include <tmmintrin.h>
+#endif
+
+static const char HEX[17] = "0123456789ABCDEF";
+
+#if defined(__SSSE3__)
+static void
+format16(const uint8_t *in, char *gutter, char *chars)
+{
+    const __m128i lut = _mm_loadu_si128((const __m128i *)HEX);
+    const __m128i low = _mm_set1_epi8(0x0F);
+    __m128i v = _mm_loadu_si128((const __m128i *)in);
+    __m128i hi = _mm_shuffle_epi8(lut, _mm_and_si128(_mm_srli_epi16(v, 4), low));
+    __m128i lo = _mm_shuffle_epi8(lut, _mm_and_si128(v, low));
+    char digits[32];
+    int i;
+
+    _mm_storeu_si128((__m128i *)digits, _mm_unpacklo_epi8(hi, lo));
+    _mm_storeu_si128((__m128i *)(digits + 16), _mm_unpackhi_epi8(hi, lo));
+    for (i = 0; i < 16; i++) {
+        /* one extra space after the eighth byte, as hexdump used to */
+        char *dst = gutter + 3 * i + (i >= 8);
+        dst[0] = digits[2 * i];
+        dst[1] = digits[2 * i + 1];
+    }
+
+    /* bytes >= 128 are negative in the signed compare and thus caught
+     * by the < 32 half of the mask, which is exactly what we want */
+    __m128i mask = _mm_or_si128(_mm_cmplt_epi8(v, _mm_set1_epi8(32)),
+                                _mm_cmpgt_epi8(v, _mm_set1_epi8(126)));
+    __m128i dots = _mm_and_si128(mask, _mm_set1_epi8('.'));
+    _mm_storeu_si128((__m128i *)chars,
+                     _mm_or_si128(_mm_andnot_si128(mask, v), dots));
+}
+#endif
+
+static PyObject *
+hexline(PyObject *self, PyObject *args)
+{
+    unsigned long long offset;
+    Py_buffer data;
+    PyObject *out;
+    char *p;
+    Py_ssize_t n, i;
+
+    if (!PyArg_ParseTuple(args, "Ky*", &offset, &data))
+        return NULL;
+    n = data.len;
+    if (n > 16) {
+        PyBuffer_Release(&data);
+        PyErr_SetString(PyExc_ValueError, "at most 16 bytes per line");
+        return NULL;
+    }
+
+    /* "OOOOOOOO: " + 48 character hex gutter + "  " + chars + "\n" */
+    out = PyBytes_FromStringAndSize(NULL, 10 + 48 + 2 + n + 1);
+    if (!out) {
+        PyBuffer_Release(&data);
+        return NULL;
+    }
+    p = PyBytes_AS_STRING(out);
+
+    for (i = 0; i < 8; i++)
+        p[i] = HEX[(offset >> (28 - 4 * i)) & 0xF];
+    p[8] = ':';
+    p[9] = ' ';
+    memset(p + 10, ' ', 48 + 2);
+
+#if defined(__SSSE3__)
+    if (n == 16) {
+        format16((const uint8_t *)data.buf, p + 10, p + 60);
+    } else
+#endif
+    {
+        const uint8_t *in = (const uint8_t *)data.buf;
+        for (i = 0; i < n; i++) {
+            uint8_t c = in[i];
+            char *dst = p + 10 + 3 * i + (i >= 8);
+            dst[0] = HEX[c >> 4];
+            dst[1] = HEX[c & 0xF];
+            p[60 + i] = (32 <= c && c < 127) ? c : '.';
+        }
+    }
+    p[60 + n] = '\n';
+
+    PyBuffer_Release(&data);
+    return out;
+}
+
+static PyMethodDef methods[] = {
+    {"hexline", hexline, METH_VARARGS,
+     "hexline(offset, data) -> bytes\n\n"
+     "Format up to 16 bytes as one hex dump line."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef module = {
+    PyModuleDef_HEAD_INIT, "_minimon_fasthex",
+    "Compiled hex dump line formatter for minimon.", -1, methods
+};
+
+PyMODINIT_FUNC
+PyInit__minimon_fasthex(void)
+{
+    return PyModule_Create(&module);
+}
@@ -1,8 +1,6 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-from __future__ import print_function
-
 LICENSE = """
 Copyright 2019 Udo Klein - http://www.blinkenlight.net
 
@@ -20,37 +18,32 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-VERSION = "1.3.2"
+VERSION = "2.3.1"
 
-import serial
-import serial.tools.list_ports as list_ports
 import sys
 import collections
 import argparse
+import select
+import fcntl
 import time
-import hexdump
-import threading
 import os
-import Queue
 
 Port = collections.namedtuple("Port", ["path", "description", "hardware"])
-default_port = Port("/dev/ttyUSB0", "USB0", "unknown hardware")
 default_baudrate = 57600
 
 # https://stackoverflow.com/questions/5574702/how-to-print-to-stderr-in-python
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
-# https://stackoverflow.com/questions/14207708/ioerror-errno-32-broken-pipe-python
-from signal import signal, SIGPIPE, SIG_DFL
-signal(SIGPIPE, SIG_DFL)
 
 # determine "interesting" serial ports
 # that is ports with a hardware description
-# those are the ones that might be connected with a usb serial bridge
-ports = [Port(path, description, hardware) for path, description, hardware in list_ports.comports() if hardware != "n/a"]
-if ports:
-    default_port = ports[0]
+# those are the ones that might be connected with a usb serial bridge;
+# scanning walks /sys, so this (and the heavyweight pyserial import) is
+# deferred until a default port is actually wanted
+def interesting_ports():
+    import serial.tools.list_ports as list_ports
+    return [Port(path, description, hardware) for path, description, hardware in list_ports.comports() if hardware != "n/a"]
 
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -63,8 +56,8 @@ parser.add_argument("--license", action="store_true",
                     help="print license and exit")
 
 port_group = parser.add_mutually_exclusive_group()
-port_group.add_argument("-p", "--port", type=str, default=default_port.path,
-                    help="port")
+port_group.add_argument("-p", "--port", type=str, default=argparse.SUPPRESS,
+                    help="port, defaults to the first port with a hardware description")
 
 port_group.add_argument("-pp", "-P", "--PortPattern", type=str,
                         help="grep for portname")
@@ -111,6 +104,7 @@ parser.add_argument("-v", "--verbose", action="store_true",
 
 
 def show_ports(long):
+    import serial.tools.list_ports as list_ports
     ports = [Port(path, description.strip(), hardware) for path, description, hardware in list_ports.comports() if long or hardware != "n/a"]
     for port in ports:
         print("{path} ({description}, {hardware})".format(**port._asdict()))
@@ -145,95 +139,311 @@ if early_exit:
 if args.PortPattern:
     import re
     pattern = re.compile(args.PortPattern)
-    port, = [port.path for port in ports if pattern.search(port.path)] or [None]
+    port, = [port.path for port in interesting_ports() if pattern.search(port.path)] or [None]
     if not port:
         eprint("no port found for pattern {0}".format(args.PortPattern))
         sys.exit(1)
 else:
-    port = args.port
+    port = getattr(args, "port", None)
+    if port == None:
+        ports = interesting_ports()
+        port = ports[0].path if ports else "/dev/ttyUSB0"
 
 blacklist = args.remove
 if args.remove_0 != False:                      # Notice that an empty argument would set remove_0 to None
     blacklist = (args.remove_0 or "") + "\x00"  # None can not be concatenated
+if blacklist:
+    # the output pipeline operates on bytes, so does the blacklist
+    blacklist = blacklist.encode("latin-1")
 
 now = lambda: False
-if args.timestamp:
-    from datetime import datetime
-    now = datetime.utcnow
-
-if args.short_timestamp:
-    from datetime import datetime
-    now = lambda: datetime.utcnow().strftime("%H:%M:%S.%f")
+if args.timestamp or args.short_timestamp:
+    def make_now(fmt):
+        # timestamps are sampled once per chunk, so avoid constructing a
+        # datetime object each time: the formatted second is cached and
+        # only the microseconds are recomputed until the second changes
+        cache = [None, b""]
+        def now():
+            t = time.time()
+            second = int(t)
+            if second != cache[0]:
+                cache[0] = second
+                cache[1] = time.strftime(fmt, time.gmtime(second)).encode("ascii")
+            return cache[1] + b".%06d" % int((t - second) * 1000000)
+        return now
+    now = make_now("%Y-%m-%d %H:%M:%S" if args.timestamp else "%H:%M:%S")
+
+
+# newline handling for user input: every mode is a precompiled function
+# chosen once at startup, so the per-line path has neither a branch nor
+# a mode lookup; the non-pass modes strip the line's own CR/LF in one C
+# translate pass before appending their suffix (unlike the former
+# rstrip() this keeps trailing blanks)
+def make_cook(suffix):
+    def cook(line):
+        return line.translate(None, b"\r\n") + suffix
+    return cook
+
+cook = {
+    "pass": lambda line: line,
+    "cr":   make_cook(b"\r"),
+    "lf":   make_cook(b"\n"),
+    "crlf": make_cook(b"\r\n"),
+    "none": make_cook(b"")
+}[args.newline]
+
+if args.hex:
+    import binascii
+
+    # non printable characters show up as "." in the character gutter
+    printable = bytes(c if 32 <= c < 127 else 0x2E for c in range(256))
+
+    def hexline(offset, data):
+        # same layout the hexdump library produced, but hexlify and
+        # translate do the per-byte formatting in C
+        gutter = binascii.hexlify(data, b" ", 1).upper()
+        if len(data) > 8:
+            gutter = gutter[:23] + b" " + gutter[23:]
+        return b"%08X: %-48s  %s\n" % (offset, gutter, data.translate(printable))
+
+    try:
+        # optional compiled accelerator, see _minimon_fasthex.c
+        from _minimon_fasthex import hexline
+    except ImportError:
+        pass
 
+import serial
 
+ser = None
+out_flags = None
+exit_code = 0
 try:
-    ser = serial.Serial(args.port, args.baudrate, dsrdtr=True)
+    ser = serial.Serial(port, args.baudrate, dsrdtr=True)
     if args.DTR:
         ser.setDTR(1)
         time.sleep(0.25)
         ser.setDTR(0)
 
-
-    def read(queue):
-        try:
-            if args.skip_bytes > 0:
-                ser.read(args.skip_bytes)
-
-            if args.skip_lines > 0:
-                for dummy in xrange(0, args.skip_lines):
-                    ser.readline()
-
-            while True:
-                s = ser.read(16) if args.hex else ser.readline()
-                queue.put((s, now()))
-        except serial.SerialException as ex:
-            eprint(ex)
-            sys.exit(1)
-
-    def write(queue):
+    # let the driver coalesce bursts: a blocking read only returns once
+    # a full dump line (hex mode) respectively a decent chunk has
+    # accumulated or the 0.1s VTIME interbyte timer expired, which cuts
+    # the syscall rate at high baud rates while VTIME bounds the worst
+    # case latency (pyserial configures VMIN=0, i.e. return immediately)
+    import termios
+    attr = termios.tcgetattr(ser.fileno())
+    attr[6][termios.VMIN] = 16 if args.hex else 64
+    attr[6][termios.VTIME] = 1
+    termios.tcsetattr(ser.fileno(), termios.TCSANOW, attr)
+
+    # the skips still use the comfortable blocking pyserial calls,
+    # the fds are only switched to non-blocking afterwards
+    if args.skip_bytes > 0:
+        ser.read(args.skip_bytes)
+
+    if args.skip_lines > 0:
+        for dummy in range(0, args.skip_lines):
+            ser.readline()
+
+    # a single epoll driven loop replaces the former read/write thread
+    # pair: with the GIL only one of them ever ran at a time anyway, so
+    # the threads bought nothing but handoff latency; blocked output must
+    # still not stall reading (it would mess up the timestamps), which is
+    # what the non-blocking stdout plus the outbuf backlog is for
+    ser_fd = ser.fileno()
+    out_fd = sys.stdout.fileno()
+    in_fd = sys.stdin.fileno()
+
+    fcntl.fcntl(ser_fd, fcntl.F_SETFL, fcntl.fcntl(ser_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    # O_NONBLOCK lives on the open file description which may be shared
+    # with the terminal, hence the flags are restored on exit
+    out_flags = fcntl.fcntl(out_fd, fcntl.F_GETFL)
+    fcntl.fcntl(out_fd, fcntl.F_SETFL, out_flags | os.O_NONBLOCK)
+
+    ep = select.epoll()
+    ep.register(ser_fd, select.EPOLLIN | select.EPOLLET)
+
+    pieces = []           # formatted output of the current burst, one
+                          # writev submits them all without joining
+    outbuf = bytearray()  # formatted output stdout did not accept yet
+    outbuf_limit = 10 * 1024 * 1024  # oldest output beyond this backlog is dropped
+    out_registered = False
+    dropped = 0
+    last_drop_report = 0
+    hex_offset = 0        # running offset of the hex dump
+    tail = bytearray()    # incomplete serial line (line mode)
+    inbuf = bytearray()   # incomplete user input line
+    rbuf = bytearray(4096)        # reused read buffer: readv fills it in
+    rview = memoryview(rbuf)      # place, no fresh bytes object per burst
+
+    # the mode flags are invariant after startup, so emit() is composed
+    # once from the matching payload formatter and timestamp wrapper
+    # instead of re-testing the flags for every chunk
+    if args.hex:
+        def payload(s):
+            global hex_offset
+            line = hexline(hex_offset, s)
+            hex_offset += len(s)
+            return line
+    elif blacklist:
+        def payload(s):
+            # translate with a delete set runs the filter in one C loop
+            return s.translate(None, blacklist)
+    else:
+        def payload(s):
+            return s
+
+    if args.timestamp or args.short_timestamp:
+        def emit(s, timestamp):
+            pieces.append(timestamp)
+            pieces.append(b" ")
+            pieces.append(payload(s))
+    else:
+        def emit(s, timestamp):
+            pieces.append(payload(s))
+
+    def handle_serial():
+        # edge-triggered: drain the fd completely, one read per burst
+        timestamp = now()  # one timestamp per burst
         while True:
-            s, now = queue.get()
-            if now:
-                print(now, end=" ")
+            try:
+                n = os.readv(ser_fd, [rbuf])
+            except BlockingIOError:
+                return
+            if not n:
+                # pyserial configures VMIN=0, so a drained fd reads
+                # empty instead of raising EAGAIN
+                return
+            chunk = rview[:n]
             if args.hex:
-                hexdump.hexdump(s)
+                for i in range(0, n, 16):
+                    emit(bytes(chunk[i:i + 16]), timestamp)
             else:
-                if blacklist:
-                    print("".join(c for c in s if c not in blacklist), end="")
-                else:
-                    print(s, end="")
-            sys.stdout.flush()
-
-
-    queue = Queue.Queue()
-
-    # read in a separate thread such that blocked output will not stop reading
-    # in particular such that blocked output will not mess up timestamps
-    thread = threading.Thread(target=write, args=[queue])
-    thread.daemon = True
-    thread.start()
-
-    # output in a separate thread as well such that we can handle user input in
-    # the main process
-    thread = threading.Thread(target=read, args=[queue])
-    thread.daemon = True
-    thread.start()
-
-    # main thread: handle user input
-    newline_suffix = {
-        "pass": None,
-        "cr":   "\r",
-        "lf":   "\n",
-        "crlf": "\r\n",
-        "none": ""
-    }[args.newline]
-    while True:
-        line = sys.stdin.readline()
-        cooked_line = line if newline_suffix == None else line.rstrip() + newline_suffix
-        ser.write(cooked_line)
+                tail.extend(chunk)
+                while True:
+                    cut = tail.find(b"\n") + 1
+                    if not cut:
+                        break
+                    emit(bytes(tail[:cut]), timestamp)
+                    del tail[:cut]
+
+    try:
+        iov_max = os.sysconf("SC_IOV_MAX")
+    except (ValueError, OSError):
+        iov_max = 1024
+
+    def pump_stdout():
+        # push as much as stdout accepts right now; only while there is
+        # a backlog is stdout watched for writability
+        global out_registered, dropped, last_drop_report
+        if outbuf:
+            # new output has to queue up behind the existing backlog
+            for piece in pieces:
+                outbuf.extend(piece)
+            del pieces[:]
+        while pieces:
+            try:
+                n = os.writev(out_fd, pieces[:iov_max])
+            except BlockingIOError:
+                # stdout is saturated, flatten the rest into the backlog
+                for piece in pieces:
+                    outbuf.extend(piece)
+                del pieces[:]
+                break
+            while pieces and n >= len(pieces[0]):
+                n -= len(pieces.pop(0))
+            if n:
+                pieces[0] = pieces[0][n:]
+        while outbuf:
+            try:
+                n = os.write(out_fd, outbuf)
+            except BlockingIOError:
+                break
+            del outbuf[:n]
+        # a reader that stays blocked must not make us hoard memory
+        # forever: cap the backlog and sacrifice the oldest output
+        overflow = len(outbuf) - outbuf_limit
+        if overflow > 0:
+            del outbuf[:overflow]
+            dropped += overflow
+            if time.monotonic() - last_drop_report >= 1:
+                last_drop_report = time.monotonic()
+                eprint("output blocked, dropped {0} bytes so far".format(dropped))
+        if outbuf and not out_registered:
+            ep.register(out_fd, select.EPOLLOUT)
+            out_registered = True
+        elif not outbuf and out_registered:
+            ep.unregister(out_fd)
+            out_registered = False
+
+    def send_line(line):
+        ser.write(cook(line))
+
+    def handle_stdin():
+        data = os.read(in_fd, 4096)
+        if data:
+            inbuf.extend(data)
+            while True:
+                cut = inbuf.find(b"\n") + 1
+                if not cut:
+                    break
+                send_line(bytes(inbuf[:cut]))
+                del inbuf[:cut]
+            return True
+        # EOF: flush a trailing partial line (as readline used to),
+        # then keep monitoring the port
+        if inbuf:
+            send_line(bytes(inbuf))
+            inbuf.clear()
+        if in_pollable:
+            ep.unregister(in_fd)
+        return False
+
+    in_pollable = True
+    try:
+        ep.register(in_fd, select.EPOLLIN)
+    except PermissionError:
+        # epoll refuses regular files, but those never block anyway:
+        # feed the whole redirected input to the port right away
+        in_pollable = False
+        while handle_stdin():
+            pass
 
+    while True:
+        for fd, event in ep.poll():
+            if fd == ser_fd:
+                if event & (select.EPOLLHUP | select.EPOLLERR):
+                    raise serial.SerialException("port closed")
+                handle_serial()
+            elif fd == in_fd:
+                handle_stdin()
+            # out_fd readiness needs no handler of its own,
+            # pump_stdout below retries the backlog anyway
+        pump_stdout()
+
+except BrokenPipeError:
+    # whoever read our output hung up, there is nothing left to flush
+    # it into; formerly SIGPIPE simply killed us, losing the port
+    # cleanup below along the way
+    del pieces[:]
+    outbuf.clear()
 except IOError as ex:
     eprint(ex)
-    sys.exit(1)
+    exit_code = 1
 except KeyboardInterrupt:
-    sys.exit(130)
+    exit_code = 130
+finally:
+    # cooperative shutdown: put the terminal flags back, hand any
+    # backlog to stdout with a blocking write, close the port
+    if out_flags != None:
+        fcntl.fcntl(out_fd, fcntl.F_SETFL, out_flags)
+        for piece in pieces:
+            outbuf.extend(piece)
+        if outbuf:
+            try:
+                os.write(out_fd, outbuf)
+            except OSError:
+                pass
+    if ser:
+        ser.close()
+
+sys.exit(exit_code)